@@ -3,12 +3,36 @@
 # Run: streamlit run app.py
 
 import os
-from datetime import date, timedelta
+from datetime import date
 
 import altair as alt
 import pandas as pd
 import streamlit as st
 
+import query_engine
+from query_engine import (
+    CHEMICALS,
+    FOCUS_AREAS,
+    INTAKE_FORMS,
+    REQUIRED_COLS,
+    SEX_OPTIONS,
+    DosageSketchIndex,
+    append_record_to_csv,
+    apply_sidebar_filters,
+    avg_outcome_by_chemical,
+    client_ids_for,
+    df_to_csv_bytes,
+    dosage_outcome_distribution,
+    dosage_percentiles_for,
+    format_for_display,
+    pick_best_row_for_client,
+    rating_histogram_by_chemical,
+    safe_str,
+    search_filter,
+    summary_metrics,
+    treatments_by_focus_area,
+)
+
 
 # ----------------------------
 # Page config + basic styling
@@ -47,143 +71,18 @@ st.markdown(SIDEBAR_BUTTONS_CSS, unsafe_allow_html=True)
 # ----------------------------
 # Constants
 # ----------------------------
-CSV_PATH = "seed_data.csv"
+# PPN_CSV_PATH points the app at another dataset (load_test.py uses it for synthetic data)
+CSV_PATH = os.environ.get("PPN_CSV_PATH", "seed_data.csv")
 LOGO_PATH = "logo.png"
 
-FOCUS_AREAS = ["PTSD", "Addiction", "General Personal Health", "Spirituality"]
-
-# Cannabis is included (filters + Add Record dropdown)
-CHEMICALS = ["Psilocybin", "Ketamine", "MDMA", "DMT", "LSD", "Cannabis", "Other"]
-
-INTAKE_FORMS = ["Inhaled", "Eaten", "Drank", "Injected", "Topical", "Other"]
-SEX_OPTIONS = ["M", "F", "Non-Binary"]
-
-REQUIRED_COLS = [
-    "Practitioner_Name",
-    "Client_ID",
-    "Treatment_Date",
-    "Patient_Age",
-    "Patient_Sex",
-    "Focus_Area",
-    "Chemical_Used",
-    "Dosage_Mg",
-    "Intake_Form",
-    "Protocol_Description",
-    "Treatment_Outcome_Rating",
-    "Detailed_Results",
-    "Next_Steps",
-]
-
 
 # ----------------------------
 # Data helpers
 # ----------------------------
-def make_fallback_dataset() -> pd.DataFrame:
-    """Small synthetic dataset so the app still runs if the CSV is missing."""
-    today = date.today()
-    rows = [
-        {
-            "Practitioner_Name": "Dr. A. Smith",
-            "Client_ID": "P-1024",
-            "Treatment_Date": str(today - timedelta(days=30)),
-            "Patient_Age": 34,
-            "Patient_Sex": "F",
-            "Focus_Area": "PTSD",
-            "Chemical_Used": "Ketamine",
-            "Dosage_Mg": 85,
-            "Intake_Form": "Injected",
-            "Protocol_Description": "Used a monitored ketamine session with guided imagery and integration.",
-            "Treatment_Outcome_Rating": 4,
-            "Detailed_Results": "Patient reported fewer intrusive thoughts and improved sleep over the next week.",
-            "Next_Steps": "Follow up in 2 weeks.",
-        },
-        {
-            "Practitioner_Name": "Clinician B. Jones",
-            "Client_ID": "P-3921",
-            "Treatment_Date": str(today - timedelta(days=90)),
-            "Patient_Age": 52,
-            "Patient_Sex": "M",
-            "Focus_Area": "Addiction",
-            "Chemical_Used": "Psilocybin",
-            "Dosage_Mg": 25,
-            "Intake_Form": "Eaten",
-            "Protocol_Description": "Used a supervised session with a structured preparation and integration plan.",
-            "Treatment_Outcome_Rating": 5,
-            "Detailed_Results": "Patient reported lower cravings and stronger commitment to a relapse prevention plan.",
-            "Next_Steps": "Integration therapy scheduled.",
-        },
-        {
-            "Practitioner_Name": "Dr. L. Patel",
-            "Client_ID": "P-7712",
-            "Treatment_Date": str(today - timedelta(days=14)),
-            "Patient_Age": 41,
-            "Patient_Sex": "Non-Binary",
-            "Focus_Area": "General Personal Health",
-            "Chemical_Used": "Other",
-            "Dosage_Mg": 40,
-            "Intake_Form": "Topical",
-            "Protocol_Description": "Used a structured session with symptom tracking and follow up coaching.",
-            "Treatment_Outcome_Rating": 3,
-            "Detailed_Results": "Patient reported some stress reduction but had trouble focusing during the session.",
-            "Next_Steps": "Reassess in 3 weeks.",
-        },
-        {
-            "Practitioner_Name": "Clinician D. Allen",
-            "Client_ID": "P-6603",
-            "Treatment_Date": str(today - timedelta(days=7)),
-            "Patient_Age": 29,
-            "Patient_Sex": "F",
-            "Focus_Area": "Spirituality",
-            "Chemical_Used": "DMT",
-            "Dosage_Mg": 18,
-            "Intake_Form": "Inhaled",
-            "Protocol_Description": "Used a brief inhalation session with grounding and a short integration debrief.",
-            "Treatment_Outcome_Rating": 2,
-            "Detailed_Results": "Patient reported anxiety during the peak and needed extra grounding afterward.",
-            "Next_Steps": "Pause and review readiness before next session.",
-        },
-    ]
-
-    df = pd.DataFrame(rows)
-    for col in REQUIRED_COLS:
-        if col not in df.columns:
-            df[col] = ""
-    return df[REQUIRED_COLS].copy()
-
-
 @st.cache_data(show_spinner=False)
-def load_data(csv_path: str) -> pd.DataFrame:
-    """Load CSV to DataFrame, or use fallback dataset if missing/unreadable."""
-    try:
-        df = pd.read_csv(csv_path)
-    except Exception:
-        df = make_fallback_dataset()
-
-    # Ensure required columns exist
-    for col in REQUIRED_COLS:
-        if col not in df.columns:
-            df[col] = ""
-
-    # Normalize types
-    df["Patient_Age"] = pd.to_numeric(df["Patient_Age"], errors="coerce").fillna(0).astype(int)
-    df["Dosage_Mg"] = pd.to_numeric(df["Dosage_Mg"], errors="coerce").fillna(0).astype(int)
-    df["Treatment_Outcome_Rating"] = pd.to_numeric(
-        df["Treatment_Outcome_Rating"], errors="coerce"
-    ).fillna(0).astype(int)
-
-    df["Treatment_Date"] = pd.to_datetime(df["Treatment_Date"], errors="coerce")
-
-    for c in [
-        "Practitioner_Name",
-        "Client_ID",
-        "Patient_Sex",
-        "Focus_Area",
-        "Chemical_Used",
-        "Intake_Form",
-    ]:
-        df[c] = df[c].astype(str).str.strip()
-
-    return df[REQUIRED_COLS].copy()
+def load_data(csv_path: str):
+    """Cached per CSV path; see query_engine.load_data."""
+    return query_engine.load_data(csv_path)
 
 
 def clear_data_cache():
@@ -196,31 +95,14 @@ def clear_data_cache():
             pass
 
 
-def append_record_to_csv(csv_path: str, record: dict) -> None:
-    """
-    Append one row to the CSV using mode='a' so old data is preserved.
-    Raises PermissionError if the file is open/locked (common on Windows with Excel).
-    """
-    abs_path = os.path.abspath(csv_path)
-    folder = os.path.dirname(abs_path)
-    if folder:
-        os.makedirs(folder, exist_ok=True)
-
-    needs_header = (not os.path.exists(abs_path)) or (os.path.getsize(abs_path) == 0)
-    row_df = pd.DataFrame([record], columns=REQUIRED_COLS)
-
-    row_df.to_csv(
-        abs_path,
-        mode="a",
-        header=needs_header,
-        index=False,
-        encoding="utf-8",
-        lineterminator="\n",
-    )
+@st.cache_resource(show_spinner=False)
+def get_dosage_sketches(csv_path: str) -> DosageSketchIndex:
+    """Build the sketch index once per CSV; later appends update it in place."""
+    return DosageSketchIndex.from_frame(load_data(csv_path)[0])
 
 
 # ----------------------------
-# Search + filter helpers
+# Login helpers
 # ----------------------------
 def is_logged_in() -> bool:
     return bool(st.session_state.get("logged_in", False))
@@ -232,63 +114,6 @@ def require_login():
         st.stop()
 
 
-def search_filter(df_in: pd.DataFrame, query: str) -> pd.DataFrame:
-    """Text search across all columns."""
-    q = (query or "").strip()
-    if not q:
-        return df_in.copy()
-
-    q_lower = q.lower()
-    combined = df_in.astype(str).apply(lambda row: " | ".join(row.values), axis=1).str.lower()
-    return df_in.loc[combined.str.contains(q_lower, na=False)].copy()
-
-
-def apply_sidebar_filters(df_in: pd.DataFrame, focus_list, chemical_list, min_rating: int) -> pd.DataFrame:
-    """Apply the sidebar filters."""
-    out = df_in.copy()
-    if focus_list is not None:
-        out = out[out["Focus_Area"].isin(list(focus_list))]
-    if chemical_list is not None:
-        out = out[out["Chemical_Used"].isin(list(chemical_list))]
-    out = out[out["Treatment_Outcome_Rating"] >= int(min_rating)]
-    return out.copy()
-
-
-def format_for_display(df_in: pd.DataFrame) -> pd.DataFrame:
-    """Keep all columns, format date for readability."""
-    out = df_in.copy()
-    if "Treatment_Date" in out.columns and pd.api.types.is_datetime64_any_dtype(out["Treatment_Date"]):
-        out["Treatment_Date"] = out["Treatment_Date"].dt.strftime("%Y-%m-%d")
-    return out
-
-
-def safe_str(value) -> str:
-    if value is None:
-        return ""
-    s = str(value)
-    return "" if s.lower() == "nan" else s
-
-
-def pick_best_row_for_client(df_in: pd.DataFrame, client_id: str) -> pd.Series:
-    """If Client_ID appears multiple times, show the most recent one."""
-    subset = df_in[df_in["Client_ID"].astype(str) == str(client_id)].copy()
-    if subset.empty:
-        return pd.Series(dtype="object")
-
-    if "Treatment_Date" in subset.columns and pd.api.types.is_datetime64_any_dtype(subset["Treatment_Date"]):
-        subset = subset.sort_values("Treatment_Date", ascending=False, na_position="last")
-
-    return subset.iloc[0]
-
-
-def df_to_csv_bytes(df_in: pd.DataFrame) -> bytes:
-    """Convert a DataFrame to CSV bytes for download."""
-    df_out = df_in.copy()
-    if "Treatment_Date" in df_out.columns and pd.api.types.is_datetime64_any_dtype(df_out["Treatment_Date"]):
-        df_out["Treatment_Date"] = df_out["Treatment_Date"].dt.strftime("%Y-%m-%d")
-    return df_out.to_csv(index=False).encode("utf-8")
-
-
 # ----------------------------
 # Altair theme (dark-friendly) + chart builders
 # ----------------------------
@@ -332,13 +157,7 @@ def enable_altair_dark_theme():
 
 
 def build_avg_outcome_by_chemical_chart(df_in: pd.DataFrame) -> alt.Chart:
-    tmp = (
-        df_in.groupby("Chemical_Used", dropna=False)["Treatment_Outcome_Rating"]
-        .mean()
-        .reset_index()
-    )
-    tmp["Chemical_Used"] = tmp["Chemical_Used"].astype(str)
-    tmp["Treatment_Outcome_Rating"] = tmp["Treatment_Outcome_Rating"].astype(float)
+    tmp = avg_outcome_by_chemical(df_in)
 
     chart = (
         alt.Chart(tmp, title="Avg Outcome by Chemical")
@@ -363,10 +182,7 @@ def build_avg_outcome_by_chemical_chart(df_in: pd.DataFrame) -> alt.Chart:
 
 
 def build_treatments_by_focus_area_chart(df_in: pd.DataFrame) -> alt.Chart:
-    tmp = df_in["Focus_Area"].astype(str).value_counts().reset_index()
-    tmp.columns = ["Focus_Area", "Total_Treatments"]
-    tmp["Focus_Area"] = tmp["Focus_Area"].astype(str)
-    tmp["Total_Treatments"] = tmp["Total_Treatments"].astype(int)
+    tmp = treatments_by_focus_area(df_in)
 
     chart = (
         alt.Chart(tmp, title="Treatments by Focus Area")
@@ -390,6 +206,234 @@ def build_treatments_by_focus_area_chart(df_in: pd.DataFrame) -> alt.Chart:
     return chart
 
 
+def build_dosage_outcome_heatmap(df_in: pd.DataFrame) -> alt.Chart:
+    tmp = dosage_outcome_distribution(df_in)
+    bin_order = tmp.drop_duplicates("Dosage_Bin").sort_values("Dosage_Start")["Dosage_Bin"].tolist()
+
+    chart = (
+        alt.Chart(tmp, title="Dosage vs Outcome")
+        .mark_rect()
+        .encode(
+            x=alt.X("Dosage_Bin:N", sort=bin_order, title="Dosage (mg)"),
+            y=alt.Y("Treatment_Outcome_Rating:O", sort="descending", title="Outcome Rating"),
+            color=alt.Color("Records:Q", title="Records", scale=alt.Scale(scheme="blues")),
+            tooltip=[
+                alt.Tooltip("Dosage_Bin:N", title="Dosage"),
+                alt.Tooltip("Treatment_Outcome_Rating:O", title="Outcome"),
+                alt.Tooltip("Records:Q", title="Records"),
+            ],
+        )
+        .properties(height=300)
+    )
+
+    return chart
+
+
+def build_rating_histogram_chart(df_in: pd.DataFrame) -> alt.Chart:
+    tmp = rating_histogram_by_chemical(df_in)
+
+    chart = (
+        alt.Chart(tmp, title="Outcome Ratings by Chemical")
+        .mark_bar()
+        .encode(
+            x=alt.X("Treatment_Outcome_Rating:O", title="Outcome Rating"),
+            y=alt.Y("Records:Q", title="Records"),
+            color=alt.Color(
+                "Chemical_Used:N",
+                title="Chemical",
+                scale=alt.Scale(scheme="tableau20"),
+            ),
+            tooltip=[
+                alt.Tooltip("Chemical_Used:N", title="Chemical"),
+                alt.Tooltip("Treatment_Outcome_Rating:O", title="Outcome"),
+                alt.Tooltip("Records:Q", title="Records"),
+            ],
+        )
+        .properties(height=300)
+    )
+
+    return chart
+
+
+def build_dosage_percentile_chart(tmp: pd.DataFrame) -> alt.Chart:
+    base = alt.Chart(tmp, title="Dosage Percentiles by Chemical and Intake Form").encode(
+        y=alt.Y("Group:N", sort=alt.EncodingSortField("P50", order="descending"), title=None),
+        tooltip=[
+            alt.Tooltip("Chemical_Used:N", title="Chemical"),
+            alt.Tooltip("Intake_Form:N", title="Intake Form"),
+            alt.Tooltip("Records:Q", title="Records"),
+            alt.Tooltip("P10:Q", title="P10 (mg)", format=".0f"),
+            alt.Tooltip("P25:Q", title="P25 (mg)", format=".0f"),
+            alt.Tooltip("P50:Q", title="Median (mg)", format=".0f"),
+            alt.Tooltip("P75:Q", title="P75 (mg)", format=".0f"),
+            alt.Tooltip("P90:Q", title="P90 (mg)", format=".0f"),
+        ],
+    )
+
+    whisker = base.mark_rule(color="#9ca3af").encode(
+        x=alt.X("P10:Q", title="Dosage (mg)"),
+        x2="P90:Q",
+    )
+    box = base.mark_bar(size=14).encode(
+        x="P25:Q",
+        x2="P75:Q",
+        color=alt.Color(
+            "Chemical_Used:N",
+            title="Chemical",
+            scale=alt.Scale(scheme="tableau20"),
+        ),
+    )
+    median = base.mark_tick(color="#e6e6e6", thickness=2, size=14).encode(x="P50:Q")
+
+    return (whisker + box + median).properties(height=max(120, 28 * len(tmp)))
+
+
+# ----------------------------
+# Search page fragments
+# ----------------------------
+@st.fragment
+def render_metrics_and_charts(filtered_df: pd.DataFrame, query: str, focus_selected, min_rating: int):
+    # Metrics MUST use filtered_df
+    metrics = summary_metrics(filtered_df)
+    total_found = metrics["total_found"]
+    avg_rating = metrics["avg_rating"]
+
+    c1, c2, c3 = st.columns([1, 1, 2])
+    with c1:
+        st.metric("Total records found", f"{total_found}")
+    with c2:
+        st.metric("Average success rating", f"{avg_rating:.2f}" if total_found > 0 else "0.00")
+    with c3:
+        st.caption("Results reflect your text search and your sidebar filters.")
+
+    st.divider()
+
+    if total_found == 0:
+        st.warning("No records found matching your criteria.")
+        return
+
+    enable_altair_dark_theme()
+
+    st.subheader("Analytics")
+    left, right = st.columns(2)
+
+    # Charts MUST use filtered_df
+    with left:
+        st.altair_chart(
+            build_avg_outcome_by_chemical_chart(filtered_df),
+            use_container_width=True,
+        )
+
+    with right:
+        st.altair_chart(
+            build_treatments_by_focus_area_chart(filtered_df),
+            use_container_width=True,
+        )
+
+    st.subheader("Distributions")
+    left, right = st.columns(2)
+
+    with left:
+        st.altair_chart(
+            build_dosage_outcome_heatmap(filtered_df),
+            use_container_width=True,
+        )
+
+    with right:
+        st.altair_chart(
+            build_rating_histogram_chart(filtered_df),
+            use_container_width=True,
+        )
+
+    # Without a text search the cached sketches matching the sidebar filters are merged;
+    # with one, the filtered dosages are sketched directly.
+    if query.strip():
+        percentiles_df = dosage_percentiles_for(filtered_df)
+    else:
+        percentiles_df = dosage_percentiles_for(filtered_df, get_dosage_sketches(CSV_PATH), focus_selected, min_rating)
+    if not percentiles_df.empty:
+        st.altair_chart(
+            build_dosage_percentile_chart(percentiles_df),
+            use_container_width=True,
+        )
+        st.caption("Bars show the 25th to 75th percentile, whiskers the 10th to 90th, and the tick the median.")
+
+
+@st.fragment
+def render_export(filtered_df: pd.DataFrame):
+    # The CSV is only built when the button is clicked, and clicking does not rerun the page.
+    # It is not cached: the frame reflects the current data, so a cache keyed on the
+    # search and filters alone could hand back an export from before a record was added.
+    st.download_button(
+        label="📥 Download Search Results as CSV",
+        data=lambda: df_to_csv_bytes(filtered_df),
+        file_name="ppn_search_results.csv",
+        mime="text/csv",
+        help="Downloads the exact results you are currently seeing (after search and filters).",
+        on_click="ignore",
+    )
+
+
+@st.fragment
+def render_results_table(filtered_df: pd.DataFrame):
+    st.subheader("Results Table")
+    st.dataframe(
+        format_for_display(filtered_df),
+        use_container_width=True,
+        hide_index=True,
+    )
+
+
+@st.fragment
+def render_drilldown(filtered_df: pd.DataFrame):
+    st.subheader("Patient Drill-Down")
+    st.write("Select a Client ID to view full details.")
+
+    select_options = ["Select a Client ID to view full details."] + client_ids_for(filtered_df)
+
+    chosen = st.selectbox(
+        "Client ID",
+        options=select_options,
+        index=0,
+        label_visibility="collapsed",
+        help="This list is based on your current search results.",
+        key="drilldown_client",
+    )
+
+    if chosen != select_options[0]:
+        row = pick_best_row_for_client(filtered_df, chosen)
+
+        header_cols = st.columns(4)
+        header_cols[0].metric("Client ID", safe_str(row.get("Client_ID")))
+        header_cols[1].metric("Age", safe_str(row.get("Patient_Age")))
+        header_cols[2].metric("Sex", safe_str(row.get("Patient_Sex")))
+        header_cols[3].metric("Focus Area", safe_str(row.get("Focus_Area")))
+
+        protocol_cols = st.columns(5)
+        protocol_cols[0].metric("Chemical", safe_str(row.get("Chemical_Used")))
+        protocol_cols[1].metric("Dosage (mg)", safe_str(row.get("Dosage_Mg")))
+        protocol_cols[2].metric("Intake Form", safe_str(row.get("Intake_Form")))
+        protocol_cols[3].metric("Outcome Rating", safe_str(row.get("Treatment_Outcome_Rating")))
+
+        tdate = row.get("Treatment_Date")
+        if pd.notna(tdate) and hasattr(tdate, "strftime"):
+            tdate_str = tdate.strftime("%Y-%m-%d")
+        else:
+            tdate_str = safe_str(tdate)
+        protocol_cols[4].metric("Treatment Date", tdate_str)
+
+        st.divider()
+        st.markdown("#### Protocol Description")
+        st.write(safe_str(row.get("Protocol_Description")))
+
+        st.markdown("#### Clinical Notes")
+        st.markdown("**Detailed Results**")
+        st.write(safe_str(row.get("Detailed_Results")))
+
+        st.markdown("**Next Steps**")
+        st.write(safe_str(row.get("Next_Steps")))
+
+
 # ----------------------------
 # Branding header
 # ----------------------------
@@ -461,7 +505,7 @@ with st.sidebar:
 # ----------------------------
 # Load data
 # ----------------------------
-df = load_data(CSV_PATH)
+df, quarantine_df = load_data(CSV_PATH)
 
 if not os.path.exists(CSV_PATH):
     st.warning(
@@ -500,6 +544,15 @@ elif page == "Search Database":
     require_login()
     st.subheader("Search Database")
 
+    # Quarantined rows hold raw patient data, so only show them behind the login
+    if not quarantine_df.empty:
+        st.warning(
+            f"{len(quarantine_df)} row(s) in '{CSV_PATH}' did not match the expected format and were left out. "
+            "They are listed below so they can be fixed in the file."
+        )
+        with st.expander("Quarantined rows", expanded=False):
+            st.dataframe(quarantine_df, use_container_width=True, hide_index=True)
+
     st.write("Type a word like PTSD, Ketamine, MDMA, Cannabis, a client ID, or a practitioner name.")
 
     query = st.text_input(
@@ -514,107 +567,20 @@ elif page == "Search Database":
     filtered_df = search_filter(df, query)
     filtered_df = apply_sidebar_filters(filtered_df, focus_selected, chemical_selected, min_success_rating)
 
-    # Metrics MUST use filtered_df
-    total_found = int(len(filtered_df))
-    avg_rating = float(filtered_df["Treatment_Outcome_Rating"].mean()) if total_found > 0 else 0.0
+    # Each section below is a fragment: interacting with one reruns only that section.
+    # A full rerun (new search text or sidebar filters) still refreshes all of them.
+    render_metrics_and_charts(filtered_df, query, focus_selected, min_success_rating)
 
-    c1, c2, c3 = st.columns([1, 1, 2])
-    with c1:
-        st.metric("Total records found", f"{total_found}")
-    with c2:
-        st.metric("Average success rating", f"{avg_rating:.2f}" if total_found > 0 else "0.00")
-    with c3:
-        st.caption("Results reflect your text search and your sidebar filters.")
-
-    st.divider()
-
-    if total_found == 0:
-        st.warning("No records found matching your criteria.")
+    if filtered_df.empty:
         st.stop()
 
-    enable_altair_dark_theme()
-
-    st.subheader("Analytics")
-    left, right = st.columns(2)
-
-    # Charts MUST use filtered_df
-    with left:
-        st.altair_chart(
-            build_avg_outcome_by_chemical_chart(filtered_df),
-            use_container_width=True,
-        )
-
-    with right:
-        st.altair_chart(
-            build_treatments_by_focus_area_chart(filtered_df),
-            use_container_width=True,
-        )
-
-    st.download_button(
-        label="📥 Download Search Results as CSV",
-        data=df_to_csv_bytes(filtered_df),
-        file_name="ppn_search_results.csv",
-        mime="text/csv",
-        help="Downloads the exact results you are currently seeing (after search and filters).",
-    )
+    render_export(filtered_df)
 
     st.divider()
-
-    st.subheader("Results Table")
-    st.dataframe(
-        format_for_display(filtered_df),
-        use_container_width=True,
-        hide_index=True,
-    )
+    render_results_table(filtered_df)
 
     st.divider()
-    st.subheader("Patient Drill-Down")
-    st.write("Select a Client ID to view full details.")
-
-    client_ids = sorted(filtered_df["Client_ID"].astype(str).dropna().unique().tolist())
-    select_options = ["Select a Client ID to view full details."] + client_ids
-
-    chosen = st.selectbox(
-        "Client ID",
-        options=select_options,
-        index=0,
-        label_visibility="collapsed",
-        help="This list is based on your current search results.",
-        key="drilldown_client",
-    )
-
-    if chosen != select_options[0]:
-        row = pick_best_row_for_client(filtered_df, chosen)
-
-        header_cols = st.columns(4)
-        header_cols[0].metric("Client ID", safe_str(row.get("Client_ID")))
-        header_cols[1].metric("Age", safe_str(row.get("Patient_Age")))
-        header_cols[2].metric("Sex", safe_str(row.get("Patient_Sex")))
-        header_cols[3].metric("Focus Area", safe_str(row.get("Focus_Area")))
-
-        protocol_cols = st.columns(5)
-        protocol_cols[0].metric("Chemical", safe_str(row.get("Chemical_Used")))
-        protocol_cols[1].metric("Dosage (mg)", safe_str(row.get("Dosage_Mg")))
-        protocol_cols[2].metric("Intake Form", safe_str(row.get("Intake_Form")))
-        protocol_cols[3].metric("Outcome Rating", safe_str(row.get("Treatment_Outcome_Rating")))
-
-        tdate = row.get("Treatment_Date")
-        if pd.notna(tdate) and hasattr(tdate, "strftime"):
-            tdate_str = tdate.strftime("%Y-%m-%d")
-        else:
-            tdate_str = safe_str(tdate)
-        protocol_cols[4].metric("Treatment Date", tdate_str)
-
-        st.divider()
-        st.markdown("#### Protocol Description")
-        st.write(safe_str(row.get("Protocol_Description")))
-
-        st.markdown("#### Clinical Notes")
-        st.markdown("**Detailed Results**")
-        st.write(safe_str(row.get("Detailed_Results")))
-
-        st.markdown("**Next Steps**")
-        st.write(safe_str(row.get("Next_Steps")))
+    render_drilldown(filtered_df)
 
 
 # ----------------------------
@@ -751,8 +717,16 @@ elif page == "Add New Record":
             }
 
             try:
+                csv_existed = os.path.exists(CSV_PATH)
+                # Build (or fetch) the index before the append, so the new row is counted once
+                sketches = get_dosage_sketches(CSV_PATH) if csv_existed else None
                 append_record_to_csv(CSV_PATH, record)
                 clear_data_cache()
+                if sketches is not None:
+                    sketches.add(record)
+                else:
+                    # The fallback dataset was replaced by a new file, so rebuild from it.
+                    get_dosage_sketches.clear()
                 st.success("✅ Record successfully added to the PPN Database!")
                 st.caption(f"Saved to: {os.path.abspath(CSV_PATH)}")
 
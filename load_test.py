@@ -0,0 +1,360 @@
+# load_test.py
+# Headless load test: N concurrent simulated clinicians drive app.py through
+# Streamlit's app-testing API (streamlit.testing.v1.AppTest) against one worker.
+# Reports rerun latency percentiles, throughput and memory, and exits non-zero
+# when an SLO threshold is exceeded.
+#
+# AppTest keeps process-wide state while a script runs, so reruns from all
+# sessions are queued on one worker lock. Sessions still run concurrently (with
+# think time between actions), and latency includes the time spent waiting for
+# the worker, which is what a clinician feels when the worker is saturated.
+#
+# AppTest.run() always reruns the whole script, even for a widget inside an
+# st.fragment. The drill-down step is therefore reported as "drilldown_full": an
+# upper bound for the fragment-only rerun a browser session would do.
+#
+# Run: python load_test.py --sessions 16 --rows 20000 --p95-ms 1500
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import warnings
+from datetime import date, timedelta
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module; peak_rss_mb() falls back to psutil
+    resource = None
+
+import numpy as np
+import pandas as pd
+from streamlit import logger as st_logger
+from streamlit.testing.v1 import AppTest
+
+from query_engine import (
+    CHEMICALS,
+    FOCUS_AREAS,
+    INTAKE_FORMS,
+    REQUIRED_COLS,
+    SEX_OPTIONS,
+)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+
+SEARCH_TERMS = ["PTSD", "Ketamine", "Psilocybin", "follow up", "integration", "Dr.", "P-1", "anxiety", "2025-0"]
+
+PRACTITIONERS = [
+    "Dr. A. Smith",
+    "Clinician B. Jones",
+    "Dr. L. Patel",
+    "Clinician D. Allen",
+    "Dr. M. Hernandez",
+    "Dr. S. Kim",
+]
+PROTOCOLS = [
+    "Used a controlled setting with breath coaching and a structured integration conversation.",
+    "Applied a preparatory talk then a supervised session followed by a 60 minute integration debrief.",
+    "Used a low stimulation room with guided imagery and a next day integration appointment.",
+    "Used a monitored ketamine assisted psychotherapy session with vital sign checks and integration afterward.",
+]
+RESULTS = [
+    "Patient reported reduced hypervigilance and improved sleep over the next week.",
+    "Patient reported some insight but noted moderate anxiety during the peak which required coaching.",
+    "Patient reported minimal psychological effect and felt frustrated afterward.",
+    "Patient described a lasting shift in perspective and greater gratitude.",
+]
+NEXT_STEPS = [
+    "Follow up in 2 weeks to review symptoms and plan next session.",
+    "Coordinate with primary therapist and reassess in 3 weeks.",
+    "Integration session scheduled in 7 days.",
+    "Medical review scheduled and treatment paused pending reassessment.",
+]
+
+
+# ----------------------------
+# Synthetic data
+# ----------------------------
+def make_synthetic_dataset(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Random records in the seed_data.csv layout, with templated notes like the real data."""
+    rng = np.random.default_rng(seed)
+    start = date.today() - timedelta(days=730)
+    days = rng.integers(0, 730, rows)
+
+    df = pd.DataFrame(
+        {
+            "Practitioner_Name": rng.choice(PRACTITIONERS, rows),
+            "Client_ID": [f"P-{n}" for n in rng.integers(1000, 10000, rows)],
+            "Treatment_Date": [str(start + timedelta(days=int(d))) for d in days],
+            "Patient_Age": rng.integers(21, 76, rows),
+            "Patient_Sex": rng.choice(SEX_OPTIONS, rows),
+            "Focus_Area": rng.choice(FOCUS_AREAS, rows),
+            "Chemical_Used": rng.choice(CHEMICALS, rows),
+            "Dosage_Mg": rng.integers(5, 150, rows),
+            "Intake_Form": rng.choice(INTAKE_FORMS, rows),
+            "Protocol_Description": rng.choice(PROTOCOLS, rows),
+            "Treatment_Outcome_Rating": rng.integers(1, 6, rows),
+            "Detailed_Results": rng.choice(RESULTS, rows),
+            "Next_Steps": rng.choice(NEXT_STEPS, rows),
+        }
+    )
+    return df[REQUIRED_COLS]
+
+
+# ----------------------------
+# Simulated session
+# ----------------------------
+class SessionRecorder:
+    """Collects (step, latency, service time) samples from all sessions."""
+
+    def __init__(self):
+        self.samples = []
+        self.errors = []
+        self.worker = threading.Lock()
+        self._lock = threading.Lock()
+
+    def add(self, step: str, latency: float, service: float):
+        with self._lock:
+            self.samples.append((step, latency, service))
+
+    def fail(self, session_id: int, message: str):
+        with self._lock:
+            self.errors.append({"session": session_id, "error": message})
+
+
+def timed_run(at: AppTest, recorder: SessionRecorder, step: str, think_seconds: float = 0.0) -> AppTest:
+    """Pause like a user would, then rerun the script and record wait + run time."""
+    if think_seconds > 0:
+        time.sleep(think_seconds)
+
+    t0 = time.perf_counter()
+    with recorder.worker:
+        t1 = time.perf_counter()
+        at.run()
+        t2 = time.perf_counter()
+    recorder.add(step, t2 - t0, t2 - t1)
+    if at.exception:
+        raise RuntimeError(f"{step}: {at.exception[0].message}")
+    return at
+
+
+def find_by_label(elements, label: str):
+    for el in elements:
+        if el.label == label:
+            return el
+    raise LookupError(f"No widget labelled {label!r}")
+
+
+def run_session(session_id: int, args, recorder: SessionRecorder, start_barrier: threading.Barrier):
+    rng = random.Random(args.seed + session_id)
+
+    def rerun(at: AppTest, step: str) -> AppTest:
+        return timed_run(at, recorder, step, rng.uniform(0, 2 * args.think_ms) / 1000)
+
+    try:
+        start_barrier.wait()
+        for iteration in range(args.iterations):
+            at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+            rerun(at, "initial_load")
+
+            find_by_label(at.text_input, "Username").set_value("admin")
+            find_by_label(at.text_input, "Password").set_value("password")
+            find_by_label(at.button, "Log in").click()
+            rerun(at, "login")
+
+            at.sidebar.radio[0].set_value("Search Database")
+            rerun(at, "open_search")
+
+            for term in rng.sample(SEARCH_TERMS, k=min(args.searches, len(SEARCH_TERMS))):
+                at.text_input(key="main_search").set_value(term)
+                rerun(at, "search")
+
+            at.text_input(key="main_search").set_value("")
+            rerun(at, "search")
+
+            at.multiselect(key="filter_chemical").set_value(rng.sample(CHEMICALS, k=3))
+            rerun(at, "filter_chemical")
+
+            at.multiselect(key="filter_focus").set_value(rng.sample(FOCUS_AREAS, k=2))
+            rerun(at, "filter_focus")
+
+            at.slider(key="filter_min_rating").set_value(rng.randint(1, 3))
+            rerun(at, "filter_rating")
+
+            for _ in range(args.drilldowns):
+                try:
+                    picker = at.selectbox(key="drilldown_client")
+                except KeyError:
+                    break  # no results for these filters, so no drill-down section
+                if len(picker.options) < 2:
+                    break
+                picker.set_value(rng.choice(picker.options[1:]))
+                rerun(at, "drilldown_full")
+
+            if args.submit and iteration == 0:
+                at.sidebar.radio[0].set_value("Add New Record")
+                rerun(at, "open_add_record")
+
+                find_by_label(at.text_input, "Practitioner Name").set_value(rng.choice(PRACTITIONERS))
+                find_by_label(at.text_input, "Client ID").set_value(f"P-LT{session_id:03d}")
+                find_by_label(at.text_area, "Detailed Results").set_value(rng.choice(RESULTS))
+                find_by_label(at.text_input, "Next Steps").set_value(rng.choice(NEXT_STEPS))
+                find_by_label(at.button, "Submit").click()
+                rerun(at, "submit_record")
+    except Exception as e:
+        recorder.fail(session_id, f"{e}\n{traceback.format_exc(limit=3)}")
+
+
+# ----------------------------
+# Report + SLO checks
+# ----------------------------
+def peak_rss_mb():
+    """Peak resident memory in MB, or None when it cannot be measured on this platform."""
+    if resource is not None:
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    mem = psutil.Process().memory_info()
+    # peak_wset is the Windows peak working set; other platforms only report current RSS
+    return getattr(mem, "peak_wset", mem.rss) / (1024 * 1024)
+
+
+def summarize(recorder: SessionRecorder, wall_seconds: float) -> dict:
+    steps = {}
+    for step, latency, _ in recorder.samples:
+        steps.setdefault(step, []).append(latency * 1000)
+
+    def pct(values):
+        arr = np.asarray(values, dtype=float)
+        p50, p95, p99 = np.percentile(arr, [50, 95, 99]) if len(arr) else (0.0, 0.0, 0.0)
+        return {"count": int(len(arr)), "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+    all_ms = [latency * 1000 for _, latency, _ in recorder.samples]
+    service_ms = [service * 1000 for _, _, service in recorder.samples]
+    return {
+        "overall": pct(all_ms),
+        "service": pct(service_ms),
+        "steps": {step: pct(values) for step, values in sorted(steps.items())},
+        "wall_seconds": wall_seconds,
+        "reruns_per_second": len(all_ms) / wall_seconds if wall_seconds > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "errors": recorder.errors,
+    }
+
+
+def check_slos(report: dict, args) -> list:
+    overall = report["overall"]
+    limits = [
+        ("p50_ms", args.p50_ms),
+        ("p95_ms", args.p95_ms),
+        ("p99_ms", args.p99_ms),
+    ]
+    failures = [
+        f"{name} {overall[name]:.0f} ms > {limit:.0f} ms" for name, limit in limits if limit is not None and overall[name] > limit
+    ]
+    if args.min_throughput is not None and report["reruns_per_second"] < args.min_throughput:
+        failures.append(f"throughput {report['reruns_per_second']:.1f}/s < {args.min_throughput:.1f}/s")
+    if args.max_rss_mb is not None and report["peak_rss_mb"] is None:
+        failures.append("peak RSS is not measurable here (install psutil)")
+    elif args.max_rss_mb is not None and report["peak_rss_mb"] > args.max_rss_mb:
+        failures.append(f"peak RSS {report['peak_rss_mb']:.0f} MB > {args.max_rss_mb:.0f} MB")
+    if report["errors"]:
+        failures.append(f"{len(report['errors'])} session(s) failed")
+    return failures
+
+
+def print_report(report: dict, args):
+    print(f"\nSessions: {args.sessions}  Rows: {args.rows}  Iterations: {args.iterations}")
+    print(f"{'step':<18}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, stats in list(report["steps"].items()) + [("ALL", report["overall"])]:
+        print(f"{step:<18}{stats['count']:>7}{stats['p50_ms']:>10.0f}{stats['p95_ms']:>10.0f}{stats['p99_ms']:>10.0f}")
+    if "drilldown_full" in report["steps"]:
+        print("(drilldown_full is a full-script rerun: an upper bound for the fragment rerun in a browser)")
+    service = report["service"]
+    print(f"\nRun time without queueing: p50 {service['p50_ms']:.0f} ms  p95 {service['p95_ms']:.0f} ms")
+    print(f"Wall time: {report['wall_seconds']:.1f} s  Throughput: {report['reruns_per_second']:.1f} reruns/s")
+    peak = report["peak_rss_mb"]
+    print(f"Peak RSS: {peak:.0f} MB" if peak is not None else "Peak RSS: n/a")
+    for err in report["errors"]:
+        print(f"\nSession {err['session']} failed: {err['error']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the PPN Streamlit app.")
+    parser.add_argument("--sessions", type=int, default=8, help="Concurrent simulated clinicians (default: 8)")
+    parser.add_argument("--rows", type=int, default=5000, help="Synthetic dataset size (default: 5000)")
+    parser.add_argument("--iterations", type=int, default=2, help="Full workflows per session (default: 2)")
+    parser.add_argument("--searches", type=int, default=3, help="Search queries typed per workflow (default: 3)")
+    parser.add_argument("--drilldowns", type=int, default=3, help="Drill-down picks per workflow (default: 3)")
+    parser.add_argument("--no-submit", dest="submit", action="store_false", help="Skip the Add New Record step")
+    parser.add_argument("--think-ms", type=float, default=300.0, help="Mean pause between user actions (default: 300)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for data and session behaviour")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-rerun timeout in seconds (default: 120)")
+    parser.add_argument("--p50-ms", type=float, default=None, help="SLO: max p50 rerun latency")
+    parser.add_argument("--p95-ms", type=float, default=None, help="SLO: max p95 rerun latency")
+    parser.add_argument("--p99-ms", type=float, default=None, help="SLO: max p99 rerun latency")
+    parser.add_argument("--min-throughput", type=float, default=None, help="SLO: min reruns per second")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="SLO: max peak resident memory")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    warnings.simplefilter("ignore")
+    st_logger.set_log_level("error")
+
+    workdir = tempfile.mkdtemp(prefix="ppn_load_test_")
+    csv_path = os.path.join(workdir, "load_test_data.csv")
+    make_synthetic_dataset(args.rows, seed=args.seed).to_csv(csv_path, index=False, lineterminator="\n")
+
+    # The app reads PPN_CSV_PATH at import time and resolves logo.png relative to the cwd
+    os.environ["PPN_CSV_PATH"] = csv_path
+    os.chdir(APP_DIR)
+
+    recorder = SessionRecorder()
+    barrier = threading.Barrier(args.sessions)
+    threads = [
+        threading.Thread(target=run_session, args=(i, args, recorder, barrier), daemon=True)
+        for i in range(args.sessions)
+    ]
+
+    t0 = time.perf_counter()
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = summarize(recorder, time.perf_counter() - t0)
+    report["config"] = vars(args)
+    print_report(report, args)
+
+    failures = check_slos(report, args)
+    report["slo_failures"] = failures
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if failures:
+        print("\nSLO FAILED: " + "; ".join(failures))
+        return 1
+    print("\nSLO OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,893 @@
+# query_engine.py
+# Loading, search, filter and aggregation logic for the PPN dataset.
+# No Streamlit dependency: used by app.py, query_server.py and reporting jobs.
+
+import csv
+import math
+import os
+import random
+import threading
+import warnings
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+
+
+# ----------------------------
+# Constants
+# ----------------------------
+FOCUS_AREAS = ["PTSD", "Addiction", "General Personal Health", "Spirituality"]
+
+# Cannabis is included (filters + Add Record dropdown)
+CHEMICALS = ["Psilocybin", "Ketamine", "MDMA", "DMT", "LSD", "Cannabis", "Other"]
+
+INTAKE_FORMS = ["Inhaled", "Eaten", "Drank", "Injected", "Topical", "Other"]
+SEX_OPTIONS = ["M", "F", "Non-Binary"]
+
+REQUIRED_COLS = [
+    "Practitioner_Name",
+    "Client_ID",
+    "Treatment_Date",
+    "Patient_Age",
+    "Patient_Sex",
+    "Focus_Area",
+    "Chemical_Used",
+    "Dosage_Mg",
+    "Intake_Form",
+    "Protocol_Description",
+    "Treatment_Outcome_Rating",
+    "Detailed_Results",
+    "Next_Steps",
+]
+
+RATING_VALUES = [1, 2, 3, 4, 5]
+DOSAGE_BIN_COUNT = 10
+DOSAGE_PERCENTILES = [0.10, 0.25, 0.50, 0.75, 0.90]
+SKETCH_K = 200
+
+# Column types for the CSV schema. Anything not listed is free text.
+COLUMN_TYPES = {
+    "Treatment_Date": "date",
+    "Patient_Age": "int",
+    "Dosage_Mg": "int",
+    "Treatment_Outcome_Rating": "int",
+}
+DATE_FORMAT = "%Y-%m-%d"
+
+# Inclusive bounds for the int columns; values outside are quarantined, not cast
+COLUMN_RANGES = {
+    "Patient_Age": (0, 130),
+    "Dosage_Mg": (0, 100_000),
+    "Treatment_Outcome_Rating": (1, 5),
+}
+
+QUARANTINE_COLS = ["Line", "Reason"] + REQUIRED_COLS
+
+# Free-text columns made mostly of reused template sentences (stored dictionary-encoded)
+NOTE_COLS = ["Protocol_Description", "Detailed_Results", "Next_Steps"]
+
+# Search text is a case-insensitive regex; queries using any of these match whole joined rows
+REGEX_METACHARS = set(".^$*+?{}[]\\|()")
+
+QUERY_SECTIONS = [
+    "summary",
+    "avg_outcome_by_chemical",
+    "treatments_by_focus_area",
+    "dosage_outcome",
+    "rating_histogram",
+    "dosage_percentiles",
+    "rows",
+]
+DEFAULT_ROW_LIMIT = 100
+
+
+# ----------------------------
+# Loading + storage
+# ----------------------------
+def make_fallback_dataset() -> pd.DataFrame:
+    """Small synthetic dataset so the app still runs if the CSV is missing."""
+    today = date.today()
+    rows = [
+        {
+            "Practitioner_Name": "Dr. A. Smith",
+            "Client_ID": "P-1024",
+            "Treatment_Date": str(today - timedelta(days=30)),
+            "Patient_Age": 34,
+            "Patient_Sex": "F",
+            "Focus_Area": "PTSD",
+            "Chemical_Used": "Ketamine",
+            "Dosage_Mg": 85,
+            "Intake_Form": "Injected",
+            "Protocol_Description": "Used a monitored ketamine session with guided imagery and integration.",
+            "Treatment_Outcome_Rating": 4,
+            "Detailed_Results": "Patient reported fewer intrusive thoughts and improved sleep over the next week.",
+            "Next_Steps": "Follow up in 2 weeks.",
+        },
+        {
+            "Practitioner_Name": "Clinician B. Jones",
+            "Client_ID": "P-3921",
+            "Treatment_Date": str(today - timedelta(days=90)),
+            "Patient_Age": 52,
+            "Patient_Sex": "M",
+            "Focus_Area": "Addiction",
+            "Chemical_Used": "Psilocybin",
+            "Dosage_Mg": 25,
+            "Intake_Form": "Eaten",
+            "Protocol_Description": "Used a supervised session with a structured preparation and integration plan.",
+            "Treatment_Outcome_Rating": 5,
+            "Detailed_Results": "Patient reported lower cravings and stronger commitment to a relapse prevention plan.",
+            "Next_Steps": "Integration therapy scheduled.",
+        },
+        {
+            "Practitioner_Name": "Dr. L. Patel",
+            "Client_ID": "P-7712",
+            "Treatment_Date": str(today - timedelta(days=14)),
+            "Patient_Age": 41,
+            "Patient_Sex": "Non-Binary",
+            "Focus_Area": "General Personal Health",
+            "Chemical_Used": "Other",
+            "Dosage_Mg": 40,
+            "Intake_Form": "Topical",
+            "Protocol_Description": "Used a structured session with symptom tracking and follow up coaching.",
+            "Treatment_Outcome_Rating": 3,
+            "Detailed_Results": "Patient reported some stress reduction but had trouble focusing during the session.",
+            "Next_Steps": "Reassess in 3 weeks.",
+        },
+        {
+            "Practitioner_Name": "Clinician D. Allen",
+            "Client_ID": "P-6603",
+            "Treatment_Date": str(today - timedelta(days=7)),
+            "Patient_Age": 29,
+            "Patient_Sex": "F",
+            "Focus_Area": "Spirituality",
+            "Chemical_Used": "DMT",
+            "Dosage_Mg": 18,
+            "Intake_Form": "Inhaled",
+            "Protocol_Description": "Used a brief inhalation session with grounding and a short integration debrief.",
+            "Treatment_Outcome_Rating": 2,
+            "Detailed_Results": "Patient reported anxiety during the peak and needed extra grounding afterward.",
+            "Next_Steps": "Pause and review readiness before next session.",
+        },
+    ]
+
+    df = pd.DataFrame(rows)
+    for col in REQUIRED_COLS:
+        if col not in df.columns:
+            df[col] = ""
+    return df[REQUIRED_COLS].copy()
+
+
+_INT_TEXT_RE = r"^-?\d{1,15}(\.0*)?$"
+
+
+def clean_header(name) -> str:
+    """Header names as written by older exports can carry stray whitespace or a trailing backslash."""
+    return str(name).strip().rstrip("\\").strip()
+
+
+def read_csv_header(csv_path: str) -> list:
+    # utf-8-sig drops the byte-order mark Excel writes; pyarrow skips it as well
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        first = f.readline()
+    return next(csv.reader([first]), [])
+
+
+def compile_csv_schema(header: list) -> dict:
+    """
+    Turn REQUIRED_COLS + COLUMN_TYPES into pyarrow read options for this file's header.
+    Typed columns are read as text and cast in validate_and_type(), so one bad value
+    quarantines its row instead of failing the whole read.
+    """
+    raw_by_clean = {}
+    for raw in header:
+        clean = clean_header(raw)
+        if clean in REQUIRED_COLS and clean not in raw_by_clean:
+            raw_by_clean[clean] = raw
+
+    column_types = {}
+    for clean, raw in raw_by_clean.items():
+        # The last column may carry a trailing backslash, so it is cleaned as plain text first
+        if clean in NOTE_COLS and raw != header[-1]:
+            column_types[raw] = pa.dictionary(pa.int32(), pa.string())
+        else:
+            column_types[raw] = pa.string()
+
+    return {
+        "include_columns": list(raw_by_clean.values()),
+        "column_types": column_types,
+        "rename": {raw: clean for clean, raw in raw_by_clean.items()},
+        "last_raw": header[-1] if header else None,
+    }
+
+
+def read_csv_with_schema(csv_path: str):
+    """
+    Read the CSV with pyarrow per the schema. Returns (table, malformed rows, header).
+    Rows with too few or too many fields are skipped and reported with their record number.
+    """
+    header = read_csv_header(csv_path)
+    schema = compile_csv_schema(header)
+    malformed = []
+
+    def on_invalid_row(row):
+        # number counts records from 1 with the header included; it is only set when single-threaded
+        malformed.append({"ordinal": row.number - 1, "text": row.text, "expected": row.expected_columns, "actual": row.actual_columns})
+        return "skip"
+
+    table = pa_csv.read_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(use_threads=False),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=on_invalid_row),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=schema["column_types"],
+            include_columns=schema["include_columns"],
+        ),
+    )
+
+    last_raw = schema["last_raw"]
+    if last_raw in table.column_names:
+        i = table.column_names.index(last_raw)
+        table = table.set_column(i, last_raw, pc.replace_substring_regex(table[last_raw], r"\\$", ""))
+
+    table = table.rename_columns([schema["rename"][name] for name in table.column_names])
+    return table, malformed, header
+
+
+def record_start_lines(csv_path: str) -> np.ndarray:
+    """
+    Physical line (1-based) where each data record starts. A newline only ends a record
+    when it is outside quotes, i.e. when an even number of quote characters precede it.
+    """
+    with open(csv_path, "rb") as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord("\n"))
+    quotes = np.flatnonzero(data == ord('"'))
+    line_starts = np.concatenate([[0], newlines + 1])
+    line_numbers = np.arange(1, len(line_starts) + 1)
+
+    outside_quotes = np.searchsorted(quotes, line_starts) % 2 == 0
+    # A final newline leaves an empty "line" past the end; padding makes it read as blank
+    padded = np.append(data, [ord("\n")] * 2)
+    first, second = padded[line_starts], padded[line_starts + 1]
+    blank = (first == ord("\n")) | ((first == ord("\r")) & (second == ord("\n")))
+    is_start = outside_quotes & ~blank
+    # Drop the header record
+    return line_numbers[is_start][1:]
+
+
+def validate_and_type(table: pa.Table):
+    """
+    Check typed columns per row and build the DataFrame.
+    Returns (clean DataFrame, rejected rows as text, row position of each rejected row).
+    """
+    ok_all = np.ones(table.num_rows, dtype=bool)
+    reasons = np.full(table.num_rows, "", dtype=object)
+
+    # A column missing from the header would otherwise be blank in every row, so reject them all
+    for col in REQUIRED_COLS:
+        if col not in table.column_names:
+            table = table.append_column(col, pa.nulls(table.num_rows, pa.string()))
+            reasons += f"Missing column {col}; "
+            ok_all[:] = False
+
+    raw = table
+
+    for col, kind in COLUMN_TYPES.items():
+        text = pc.utf8_trim_whitespace(table[col])
+        if kind == "int":
+            try:
+                values = pc.cast(text, pa.int64())
+            except pa.ArrowInvalid:
+                # Only a column with a bad value pays for the per-row check: whole numbers
+                # (an optional ".0" is allowed) pass, anything else becomes null before the cast
+                matched = pc.fill_null(pc.match_substring_regex(text, _INT_TEXT_RE), False)
+                digits = pc.replace_substring_regex(text, r"\.0*$", "")
+                values = pc.cast(pc.if_else(matched, digits, None), pa.int64())
+        else:
+            values = pc.strptime(text, format=DATE_FORMAT, unit="us", error_is_null=True)
+        ok = pc.is_valid(values).to_numpy(zero_copy_only=False)
+
+        if col in COLUMN_RANGES:
+            low, high = COLUMN_RANGES[col]
+            ints = pc.fill_null(values, low).to_numpy(zero_copy_only=False)
+            ok &= (ints >= low) & (ints <= high)
+        table = table.set_column(table.column_names.index(col), col, values)
+
+        reasons[~ok] += f"Bad {col}; "
+        ok_all &= ok
+
+    for c in [
+        "Practitioner_Name",
+        "Client_ID",
+        "Patient_Sex",
+        "Focus_Area",
+        "Chemical_Used",
+        "Intake_Form",
+    ]:
+        table = table.set_column(table.column_names.index(c), c, pc.utf8_trim_whitespace(table[c]))
+
+    for c in NOTE_COLS:
+        if not pa.types.is_dictionary(table[c].type):
+            table = table.set_column(table.column_names.index(c), c, pc.dictionary_encode(table[c]))
+
+    table = table.select(REQUIRED_COLS)
+    bad_positions = np.flatnonzero(~ok_all)
+    df = table.filter(pa.array(ok_all)).to_pandas()
+
+    # Report the values as they were read, not the nulls left by a failed conversion
+    rejected = raw.select(REQUIRED_COLS).take(pa.array(bad_positions, pa.int64())).to_pandas().astype(object)
+    rejected.insert(0, "Reason", [r.rstrip("; ") for r in reasons[bad_positions]])
+    return df, rejected, bad_positions
+
+
+def malformed_to_frame(malformed: list, header: list) -> pd.DataFrame:
+    """Split the raw text of skipped rows back into named fields for the report."""
+    rows = []
+    for m in malformed:
+        fields = next(csv.reader([m["text"]]), [])
+        row = {col: None for col in REQUIRED_COLS}
+        for raw, value in zip(header, fields):
+            clean = clean_header(raw)
+            if clean in row:
+                row[clean] = value
+        row["Reason"] = f"Malformed row (expected {m['expected']} fields, saw {m['actual']})"
+        rows.append(row)
+    return pd.DataFrame(rows, columns=["Reason"] + REQUIRED_COLS)
+
+
+def encode_note_columns(df_in: pd.DataFrame) -> pd.DataFrame:
+    """
+    Dictionary-encode the templated note columns: each distinct sentence is stored once
+    and rows hold small integer codes. This also shrinks the pickled copy kept by caches.
+    """
+    out = df_in.copy()
+    for col in NOTE_COLS:
+        if col in out.columns and not isinstance(out[col].dtype, pd.CategoricalDtype):
+            out[col] = out[col].astype("category")
+    return out
+
+
+def load_data(csv_path: str):
+    """
+    Load CSV to (DataFrame, quarantine report), or use fallback dataset if missing/unreadable.
+    Rows with the wrong number of fields, or values that do not match COLUMN_TYPES and
+    COLUMN_RANGES, go to the report with the file line they start on.
+    """
+    try:
+        table, malformed, header = read_csv_with_schema(csv_path)
+        from_file = True
+    except Exception:
+        fallback = make_fallback_dataset().astype(str)
+        table = pa.table({c: pa.array(fallback[c].tolist(), pa.string()) for c in fallback.columns})
+        malformed, header, from_file = [], list(REQUIRED_COLS), False
+
+    missing = [col for col in REQUIRED_COLS if col not in table.column_names]
+    if missing:
+        warnings.warn(f"{csv_path}: missing required column(s) {', '.join(missing)}; every row is quarantined.")
+
+    df, rejected, bad_positions = validate_and_type(table)
+    df = encode_note_columns(df)
+
+    if len(rejected) == 0 and not malformed:
+        return df, pd.DataFrame(columns=QUARANTINE_COLS)
+
+    # Record ordinals: skipped rows know theirs; parsed rows fill the remaining slots in order
+    skipped = np.array([m["ordinal"] for m in malformed], dtype=int)
+    kept = np.ones(table.num_rows + len(skipped), dtype=bool)
+    kept[skipped - 1] = False
+    kept_ordinals = np.flatnonzero(kept) + 1
+    ordinals = np.concatenate([kept_ordinals[bad_positions], skipped]).astype(int)
+
+    quarantine = pd.concat([rejected, malformed_to_frame(malformed, header)], ignore_index=True)
+    if from_file:
+        starts = record_start_lines(csv_path)
+        quarantine.insert(0, "Line", [starts[o - 1] if o - 1 < len(starts) else None for o in ordinals])
+    else:
+        quarantine.insert(0, "Line", ordinals + 1)
+    quarantine = quarantine[QUARANTINE_COLS].sort_values("Line", kind="stable").reset_index(drop=True)
+
+    warnings.warn(f"{csv_path}: quarantined {len(quarantine)} row(s) that did not match the schema.")
+    return df, quarantine
+
+
+def append_record_to_csv(csv_path: str, record: dict) -> None:
+    """
+    Append one row to the CSV using mode='a' so old data is preserved.
+    Raises PermissionError if the file is open/locked (common on Windows with Excel).
+    """
+    abs_path = os.path.abspath(csv_path)
+    folder = os.path.dirname(abs_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    needs_header = (not os.path.exists(abs_path)) or (os.path.getsize(abs_path) == 0)
+    row_df = pd.DataFrame([record], columns=REQUIRED_COLS)
+
+    # Don't glue the new row onto a last line that has no newline
+    if not needs_header:
+        with open(abs_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            missing_newline = f.read(1) != b"\n"
+        if missing_newline:
+            with open(abs_path, "a", encoding="utf-8", newline="") as f:
+                f.write("\n")
+
+    row_df.to_csv(
+        abs_path,
+        mode="a",
+        header=needs_header,
+        index=False,
+        encoding="utf-8",
+        lineterminator="\n",
+    )
+
+
+# ----------------------------
+# Search + filter
+# ----------------------------
+def text_match_mask(series: pd.Series, q_lower: str) -> np.ndarray:
+    """Case-insensitive match on one column. Dictionary-encoded columns are checked once per distinct value."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        hits = np.asarray(series.cat.categories.astype(str).str.lower().str.contains(q_lower, na=False), dtype=bool)
+        # Code -1 (missing) picks the trailing False
+        return np.append(hits, False)[series.cat.codes.to_numpy()]
+    return series.astype(str).str.lower().str.contains(q_lower, na=False).to_numpy(dtype=bool)
+
+
+def search_filter(df_in: pd.DataFrame, query: str) -> pd.DataFrame:
+    """Text search across all columns."""
+    q = (query or "").strip()
+    if not q:
+        return df_in.copy()
+
+    q_lower = q.lower()
+    if any(ch in REGEX_METACHARS for ch in q_lower):
+        # The query is a regex: anchors and patterns like "a.*b" apply to the whole
+        # " | "-joined row, so only a plain substring can be matched column by column
+        combined = None
+        for col in df_in.columns:
+            text = df_in[col].astype(str).fillna("nan")
+            combined = text if combined is None else combined + " | " + text
+        return df_in.loc[combined.str.lower().str.contains(q_lower, na=False)].copy()
+
+    mask = np.zeros(len(df_in), dtype=bool)
+    for col in df_in.columns:
+        mask |= text_match_mask(df_in[col], q_lower)
+    return df_in.loc[mask].copy()
+
+
+def apply_sidebar_filters(df_in: pd.DataFrame, focus_list, chemical_list, min_rating: int) -> pd.DataFrame:
+    """Apply the sidebar filters."""
+    out = df_in.copy()
+    if focus_list is not None:
+        out = out[out["Focus_Area"].isin(list(focus_list))]
+    if chemical_list is not None:
+        out = out[out["Chemical_Used"].isin(list(chemical_list))]
+    out = out[out["Treatment_Outcome_Rating"] >= int(min_rating)]
+    return out.copy()
+
+
+def format_for_display(df_in: pd.DataFrame) -> pd.DataFrame:
+    """Keep all columns, format date for readability."""
+    out = df_in.copy()
+    if "Treatment_Date" in out.columns and pd.api.types.is_datetime64_any_dtype(out["Treatment_Date"]):
+        out["Treatment_Date"] = out["Treatment_Date"].dt.strftime("%Y-%m-%d")
+    return out
+
+
+def safe_str(value) -> str:
+    if value is None:
+        return ""
+    s = str(value)
+    return "" if s.lower() == "nan" else s
+
+
+def pick_best_row_for_client(df_in: pd.DataFrame, client_id: str) -> pd.Series:
+    """If Client_ID appears multiple times, show the most recent one."""
+    subset = df_in[df_in["Client_ID"].astype(str) == str(client_id)].copy()
+    if subset.empty:
+        return pd.Series(dtype="object")
+
+    if "Treatment_Date" in subset.columns and pd.api.types.is_datetime64_any_dtype(subset["Treatment_Date"]):
+        subset = subset.sort_values("Treatment_Date", ascending=False, na_position="last")
+
+    return subset.iloc[0]
+
+
+def client_ids_for(df_in: pd.DataFrame) -> list:
+    """Sorted distinct Client IDs, used for the drill-down picker."""
+    return sorted(df_in["Client_ID"].astype(str).dropna().unique().tolist())
+
+
+def df_to_csv_bytes(df_in: pd.DataFrame) -> bytes:
+    """Convert a DataFrame to CSV bytes for download."""
+    df_out = df_in.copy()
+    if "Treatment_Date" in df_out.columns and pd.api.types.is_datetime64_any_dtype(df_out["Treatment_Date"]):
+        df_out["Treatment_Date"] = df_out["Treatment_Date"].dt.strftime("%Y-%m-%d")
+    return df_out.to_csv(index=False).encode("utf-8")
+
+
+# ----------------------------
+# Aggregates for charts + metrics
+# ----------------------------
+class KLLSketch:
+    """
+    Mergeable KLL quantile sketch (Karnin, Lang & Liberty).
+
+    Keeps a bounded set of weighted samples, so percentiles are read from a few
+    hundred values instead of sorting every row. Two sketches can be merged.
+    """
+
+    def __init__(self, k: int = SKETCH_K, seed: int = 0):
+        self.k = int(k)
+        self.n = 0
+        self.compactors = [[]]
+        self._size = 0
+        self._max_size = self._capacity(0)
+        self._rng = random.Random(seed)
+
+    def _capacity(self, height: int) -> int:
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2.0 / 3.0) ** depth)) + 1
+
+    def _grow(self):
+        self.compactors.append([])
+        self._max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self):
+        while self._size >= self._max_size:
+            for height, items in enumerate(self.compactors):
+                if len(items) < self._capacity(height):
+                    continue
+                if height + 1 >= len(self.compactors):
+                    self._grow()
+
+                items.sort()
+                keep = items[-1:] if len(items) % 2 else []
+                pairs = items[: len(items) - len(keep)]
+                promoted = pairs[self._rng.randint(0, 1) :: 2]
+
+                self.compactors[height] = keep
+                self.compactors[height + 1].extend(promoted)
+                self._size -= len(pairs) - len(promoted)
+                break
+
+    def update(self, value: float):
+        self.compactors[0].append(float(value))
+        self.n += 1
+        self._size += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def update_many(self, values):
+        """Add many values, compacting in chunks so no step sorts the whole input."""
+        arr = np.asarray(values, dtype=float)
+        arr = arr[~np.isnan(arr)]
+        for start in range(0, len(arr), self.k):
+            chunk = arr[start : start + self.k].tolist()
+            self.compactors[0].extend(chunk)
+            self.n += len(chunk)
+            self._size += len(chunk)
+            if self._size >= self._max_size:
+                self._compress()
+
+    def merge(self, other: "KLLSketch") -> "KLLSketch":
+        """Fold another sketch into this one (in place) and return self."""
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+        self.n += other.n
+        self._size += other._size
+        self._compress()
+        return self
+
+    def quantiles(self, qs) -> np.ndarray:
+        """Approximate values at the given quantiles (0 to 1)."""
+        qs = np.asarray(qs, dtype=float)
+        if self._size == 0:
+            return np.full(qs.shape, np.nan)
+
+        values = np.concatenate([np.asarray(items, dtype=float) for items in self.compactors])
+        weights = np.concatenate(
+            [np.full(len(items), 2**height, dtype=float) for height, items in enumerate(self.compactors)]
+        )
+        order = np.argsort(values, kind="stable")
+        cum = np.cumsum(weights[order])
+        idx = np.searchsorted(cum, qs * cum[-1], side="left")
+        return values[order][np.clip(idx, 0, len(order) - 1)]
+
+
+class DosageSketchIndex:
+    """
+    Dosage sketches kept per (chemical, intake form, focus area, rating) and updated on append.
+    A query merges the sketches that match its sidebar filters, so percentiles cover the
+    same records as the other charts without sorting any rows.
+    """
+
+    def __init__(self, k: int = SKETCH_K):
+        self.k = int(k)
+        # (chemical, intake form) -> {(focus area, rating): KLLSketch}
+        self.sketches = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, df_in: pd.DataFrame, k: int = SKETCH_K) -> "DosageSketchIndex":
+        index = cls(k=k)
+        keys = ["Chemical_Used", "Intake_Form", "Focus_Area", "Treatment_Outcome_Rating"]
+        grouped = df_in.groupby(keys, sort=False, observed=True)["Dosage_Mg"]
+        for (chemical, intake_form, focus_area, rating), values in grouped:
+            sketch = KLLSketch(k=index.k)
+            sketch.update_many(values.to_numpy())
+            index.sketches.setdefault((str(chemical), str(intake_form)), {})[(str(focus_area), int(rating))] = sketch
+        return index
+
+    def add(self, record: dict):
+        """Count one appended record (a dict with the REQUIRED_COLS keys)."""
+        pair = (str(record["Chemical_Used"]), str(record["Intake_Form"]))
+        cell = (str(record["Focus_Area"]), int(record["Treatment_Outcome_Rating"]))
+        with self._lock:
+            cells = self.sketches.setdefault(pair, {})
+            if cell not in cells:
+                cells[cell] = KLLSketch(k=self.k)
+            cells[cell].update(record["Dosage_Mg"])
+
+    def merged(self, pairs, focus_list=None, min_rating: int = 1) -> dict:
+        """One merged sketch per (chemical, intake form) pair, over the cells that pass the filters."""
+        focus = None if focus_list is None else {str(f) for f in focus_list}
+        out = {}
+        with self._lock:
+            for chemical, intake_form in pairs:
+                pair = (str(chemical), str(intake_form))
+                sketch = KLLSketch(k=self.k)
+                for (focus_area, rating), cell in self.sketches.get(pair, {}).items():
+                    if rating >= int(min_rating) and (focus is None or focus_area in focus):
+                        sketch.merge(cell)
+                out[pair] = sketch
+        return out
+
+
+def sketch_percentiles(sketches_by_pair: dict, qs=DOSAGE_PERCENTILES) -> pd.DataFrame:
+    """One row per (chemical, intake form) pair with the requested dosage percentiles."""
+    rows = []
+    for (chemical, intake_form), sketch in sketches_by_pair.items():
+        if sketch.n == 0:
+            continue
+        row = {"Chemical_Used": chemical, "Intake_Form": intake_form, "Records": sketch.n}
+        for q, value in zip(qs, sketch.quantiles(qs)):
+            row[f"P{int(round(q * 100))}"] = float(value)
+        rows.append(row)
+
+    columns = ["Chemical_Used", "Intake_Form", "Records"] + [f"P{int(round(q * 100))}" for q in qs]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def summary_metrics(df_in: pd.DataFrame) -> dict:
+    """Record count and average outcome rating, as shown in the Search page metrics."""
+    total = int(len(df_in))
+    avg = float(df_in["Treatment_Outcome_Rating"].mean()) if total > 0 else 0.0
+    return {"total_found": total, "avg_rating": avg}
+
+
+def avg_outcome_by_chemical(df_in: pd.DataFrame) -> pd.DataFrame:
+    tmp = (
+        df_in.groupby("Chemical_Used", dropna=False)["Treatment_Outcome_Rating"]
+        .mean()
+        .reset_index()
+    )
+    tmp["Chemical_Used"] = tmp["Chemical_Used"].astype(str)
+    tmp["Treatment_Outcome_Rating"] = tmp["Treatment_Outcome_Rating"].astype(float)
+    return tmp
+
+
+def treatments_by_focus_area(df_in: pd.DataFrame) -> pd.DataFrame:
+    tmp = df_in["Focus_Area"].astype(str).value_counts().reset_index()
+    tmp.columns = ["Focus_Area", "Total_Treatments"]
+    tmp["Focus_Area"] = tmp["Focus_Area"].astype(str)
+    tmp["Total_Treatments"] = tmp["Total_Treatments"].astype(int)
+    return tmp
+
+
+def dosage_bin_edges(dosage: np.ndarray, bin_count: int = DOSAGE_BIN_COUNT) -> np.ndarray:
+    """
+    Integer bin edges from 0 with a round width (1, 2 or 5 times a power of ten).
+    Bins are half-open [start, end) and the last end is above the largest dosage, so the
+    edges only move when the maximum crosses a width step, not with every filter change.
+    """
+    top = float(np.nanmax(dosage)) if len(dosage) else 0.0
+    width = max(int(top // bin_count) + 1, 1)
+    scale = 10 ** (len(str(width)) - 1)
+    width = next(step * scale for step in (1, 2, 5, 10) if step * scale >= width)
+    return np.arange(bin_count + 1, dtype=np.int64) * width
+
+
+def dosage_outcome_distribution(df_in: pd.DataFrame, bin_count: int = DOSAGE_BIN_COUNT) -> pd.DataFrame:
+    """Count of records per (dosage bin, outcome rating), computed with one bincount."""
+    dosage = df_in["Dosage_Mg"].to_numpy(dtype=float)
+    rating = df_in["Treatment_Outcome_Rating"].to_numpy(dtype=int)
+    edges = dosage_bin_edges(dosage, bin_count)
+
+    valid = (rating >= RATING_VALUES[0]) & (rating <= RATING_VALUES[-1]) & ~np.isnan(dosage)
+    bin_idx = np.clip(np.searchsorted(edges, dosage[valid], side="right") - 1, 0, bin_count - 1)
+    flat = bin_idx * len(RATING_VALUES) + (rating[valid] - RATING_VALUES[0])
+    counts = np.bincount(flat, minlength=bin_count * len(RATING_VALUES))
+
+    starts = np.repeat(edges[:-1], len(RATING_VALUES))
+    ends = np.repeat(edges[1:], len(RATING_VALUES))
+    return pd.DataFrame(
+        {
+            "Dosage_Bin": [f"{a} to <{b} mg" for a, b in zip(starts, ends)],
+            "Dosage_Start": starts,
+            "Treatment_Outcome_Rating": np.tile(RATING_VALUES, bin_count),
+            "Records": counts.astype(int),
+        }
+    )
+
+
+def rating_histogram_by_chemical(df_in: pd.DataFrame) -> pd.DataFrame:
+    """Count of records per (chemical, outcome rating), computed with one bincount."""
+    codes, chemicals = pd.factorize(df_in["Chemical_Used"].astype(str), sort=True)
+    rating = df_in["Treatment_Outcome_Rating"].to_numpy(dtype=int)
+
+    valid = (rating >= RATING_VALUES[0]) & (rating <= RATING_VALUES[-1]) & (codes >= 0)
+    flat = codes[valid] * len(RATING_VALUES) + (rating[valid] - RATING_VALUES[0])
+    counts = np.bincount(flat, minlength=len(chemicals) * len(RATING_VALUES))
+
+    return pd.DataFrame(
+        {
+            "Chemical_Used": np.repeat(np.asarray(chemicals, dtype=object), len(RATING_VALUES)),
+            "Treatment_Outcome_Rating": np.tile(RATING_VALUES, len(chemicals)),
+            "Records": counts.astype(int),
+        }
+    )
+
+
+def dosage_percentiles_for(
+    df_in: pd.DataFrame,
+    sketches: DosageSketchIndex = None,
+    focus_list=None,
+    min_rating: int = 1,
+) -> pd.DataFrame:
+    """
+    Dosage percentiles for the filtered rows in df_in, per (chemical, intake form) pair.
+
+    With sketches, df_in must be the sidebar-filtered dataset (no text search): the index
+    cells matching focus_list and min_rating are merged. Without sketches (e.g. a text
+    search is active), each pair's sketch is built from df_in's own dosages.
+    """
+    pairs = list(
+        df_in[["Chemical_Used", "Intake_Form"]]
+        .astype(str)
+        .drop_duplicates()
+        .itertuples(index=False, name=None)
+    )
+    if sketches is not None:
+        by_pair = sketches.merged(pairs, focus_list, min_rating)
+    else:
+        by_pair = {}
+        grouped = df_in.groupby(["Chemical_Used", "Intake_Form"], sort=False, observed=True)["Dosage_Mg"]
+        for (chemical, intake_form), values in grouped:
+            sketch = KLLSketch()
+            sketch.update_many(values.to_numpy())
+            by_pair[(str(chemical), str(intake_form))] = sketch
+        by_pair = {pair: by_pair[pair] for pair in pairs}
+
+    out = sketch_percentiles(by_pair)
+    out["Group"] = out["Chemical_Used"] + " / " + out["Intake_Form"]
+    return out
+
+
+# ----------------------------
+# Batch queries
+# ----------------------------
+def frame_to_records(df_in: pd.DataFrame) -> list:
+    """JSON-safe list of row dicts (dates as YYYY-MM-DD, missing values as None)."""
+    out = format_for_display(df_in).astype(object)
+    return out.where(out.notna(), None).to_dict(orient="records")
+
+
+def needs_sketch_index(spec) -> bool:
+    """True when the spec asks for dosage percentiles without a text search (read from the index)."""
+    if not isinstance(spec, dict) or not isinstance(spec.get("include"), list):
+        return False
+    search = spec.get("search") or ""
+    return "dosage_percentiles" in spec["include"] and isinstance(search, str) and not search.strip()
+
+
+def run_query(df_in: pd.DataFrame, spec: dict, sketches: DosageSketchIndex = None, search_cache: dict = None) -> dict:
+    """
+    Evaluate one query spec against df_in, the same way the Search page does.
+
+    spec keys (all optional): id, search, focus_areas, chemicals, min_rating,
+    include (list of QUERY_SECTIONS, default ["summary"]), client_id, limit.
+    Raises ValueError for an invalid spec.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("Each query must be a JSON object.")
+
+    for key in ("include", "focus_areas", "chemicals"):
+        if spec.get(key) is not None and not isinstance(spec[key], list):
+            raise ValueError(f"'{key}' must be a list.")
+    for key in ("search", "client_id"):
+        if spec.get(key) is not None and not isinstance(spec[key], str):
+            raise ValueError(f"'{key}' must be a string.")
+
+    include = spec.get("include") or ["summary"]
+    unknown = [name for name in include if name not in QUERY_SECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown include section(s): {', '.join(map(str, unknown))}")
+
+    query = spec.get("search") or ""
+    if search_cache is not None:
+        if query not in search_cache:
+            search_cache[query] = search_filter(df_in, query)
+        searched = search_cache[query]
+    else:
+        searched = search_filter(df_in, query)
+
+    try:
+        min_rating = int(spec.get("min_rating", 1))
+        limit = int(spec.get("limit", DEFAULT_ROW_LIMIT))
+    except (TypeError, OverflowError, ValueError):
+        raise ValueError("min_rating and limit must be whole numbers.")
+
+    filtered = apply_sidebar_filters(searched, spec.get("focus_areas"), spec.get("chemicals"), min_rating)
+
+    result = {}
+    if "id" in spec:
+        result["id"] = spec["id"]
+    if "summary" in include:
+        result["summary"] = summary_metrics(filtered)
+    if "avg_outcome_by_chemical" in include:
+        result["avg_outcome_by_chemical"] = frame_to_records(avg_outcome_by_chemical(filtered))
+    if "treatments_by_focus_area" in include:
+        result["treatments_by_focus_area"] = frame_to_records(treatments_by_focus_area(filtered))
+    if "dosage_outcome" in include:
+        result["dosage_outcome"] = frame_to_records(dosage_outcome_distribution(filtered))
+    if "rating_histogram" in include:
+        result["rating_histogram"] = frame_to_records(rating_histogram_by_chemical(filtered))
+    if "dosage_percentiles" in include:
+        if not needs_sketch_index(spec):
+            # A text search narrows the rows in ways the index cells cannot, so sketch them directly
+            percentiles = dosage_percentiles_for(filtered)
+        else:
+            if sketches is None:
+                sketches = DosageSketchIndex.from_frame(df_in)
+            percentiles = dosage_percentiles_for(filtered, sketches, spec.get("focus_areas"), min_rating)
+        result["dosage_percentiles"] = frame_to_records(percentiles)
+    if "rows" in include:
+        result["rows"] = frame_to_records(filtered.head(max(limit, 0)))
+
+    client_id = spec.get("client_id")
+    if client_id:
+        row = pick_best_row_for_client(filtered, client_id)
+        result["client"] = frame_to_records(filtered.loc[[row.name]])[0] if not row.empty else None
+
+    return result
+
+
+def run_batch(df_in: pd.DataFrame, specs: list, sketches: DosageSketchIndex = None) -> list:
+    """
+    Evaluate many query specs against one shared dataset.
+    Text searches are computed once per distinct search string in the batch, and the
+    dosage sketch index (if not passed in) is built once, when a query first needs it.
+    A bad spec (including wrongly typed values, e.g. a list where a string is expected)
+    yields {"id": ..., "error": ...} instead of failing the batch.
+    """
+    search_cache = {}
+    results = []
+    for spec in specs:
+        try:
+            if sketches is None and needs_sketch_index(spec):
+                sketches = DosageSketchIndex.from_frame(df_in)
+            results.append(run_query(df_in, spec, sketches=sketches, search_cache=search_cache))
+        except (TypeError, OverflowError, ValueError) as e:
+            error = {"error": str(e)}
+            if isinstance(spec, dict) and "id" in spec:
+                error = {"id": spec["id"], **error}
+            results.append(error)
+    return results
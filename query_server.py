@@ -0,0 +1,123 @@
+# query_server.py
+# Local HTTP/JSON endpoint for batch queries against one shared in-memory dataset.
+# Run: python query_server.py --csv seed_data.csv --port 8765
+#
+# POST /query   {"queries": [{"id": 1, "search": "PTSD", "chemicals": ["Ketamine"], "include": ["summary"]}]}
+#               -> {"results": [{"id": 1, "summary": {"total_found": 3, "avg_rating": 4.0}}]}
+# POST /reload  re-reads the CSV (e.g. after records were added in the app)
+# GET  /health  -> {"status": "ok", "records": 58, "quarantined": 0}
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import query_engine
+
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+
+class QueryService:
+    """Holds the dataset and dosage sketches once; every request reads the same objects."""
+
+    def __init__(self, csv_path: str):
+        self.csv_path = csv_path
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        df, quarantine = query_engine.load_data(self.csv_path)
+        sketches = query_engine.DosageSketchIndex.from_frame(df)
+        with self._lock:
+            self.df, self.quarantine, self.sketches = df, quarantine, sketches
+
+    def snapshot(self):
+        with self._lock:
+            return self.df, self.quarantine, self.sketches
+
+    def run_batch(self, specs: list) -> list:
+        df, _, sketches = self.snapshot()
+        return query_engine.run_batch(df, specs, sketches=sketches)
+
+
+def make_handler(service: QueryService):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload: dict):
+            body = json.dumps(payload, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json(404, {"error": "Not found."})
+                return
+            df, quarantine, _ = service.snapshot()
+            self._send_json(200, {"status": "ok", "records": int(len(df)), "quarantined": int(len(quarantine))})
+
+        def do_POST(self):
+            if self.path == "/reload":
+                try:
+                    service.reload()
+                except Exception as e:
+                    self._send_json(500, {"error": f"Reload failed: {e}"})
+                    return
+                df, quarantine, _ = service.snapshot()
+                self._send_json(200, {"status": "ok", "records": int(len(df)), "quarantined": int(len(quarantine))})
+                return
+            if self.path != "/query":
+                self._send_json(404, {"error": "Not found."})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                self._send_json(400, {"error": "Content-Length must be a whole number."})
+                return
+            if length <= 0 or length > MAX_BODY_BYTES:
+                self._send_json(400, {"error": "Request body is missing or too large."})
+                return
+
+            try:
+                payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                self._send_json(400, {"error": f"Invalid JSON: {e}"})
+                return
+
+            specs = payload.get("queries") if isinstance(payload, dict) else None
+            if not isinstance(specs, list):
+                self._send_json(400, {"error": "Body must be an object with a 'queries' list."})
+                return
+
+            try:
+                results = service.run_batch(specs)
+            except Exception as e:
+                self._send_json(500, {"error": f"Query failed: {e}"})
+                return
+            self._send_json(200, {"results": results})
+
+    return QueryHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve batch PPN queries over local HTTP/JSON.")
+    parser.add_argument("--csv", default="seed_data.csv", help="CSV file to load (default: seed_data.csv)")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    args = parser.parse_args(argv)
+
+    service = QueryService(args.csv)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"Serving {len(service.df)} records from {args.csv} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
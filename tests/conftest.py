@@ -0,0 +1,7 @@
+# tests/conftest.py
+# Lets `pytest` import the app modules from the repo root without installing them.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,234 @@
+# tests/test_query_engine.py
+# Run: python -m pytest -q (from the repo root)
+
+import csv
+import io
+import os
+
+import numpy as np
+import pytest
+
+import query_engine
+from query_engine import DosageSketchIndex, KLLSketch
+
+SEED_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "seed_data.csv")
+
+
+@pytest.fixture(scope="module")
+def seed_df():
+    return query_engine.load_data(SEED_CSV)[0]
+
+
+def rank_error(values: np.ndarray, estimate: float, q: float) -> float:
+    """How far (as a fraction of n) the estimate's rank is from the requested quantile."""
+    ordered = np.sort(values)
+    low = np.searchsorted(ordered, estimate, side="left") / len(ordered)
+    high = np.searchsorted(ordered, estimate, side="right") / len(ordered)
+    return 0.0 if low <= q <= high else min(abs(q - low), abs(q - high))
+
+
+# ----------------------------
+# KLL sketch
+# ----------------------------
+def test_kll_is_exact_below_capacity():
+    values = np.arange(1, 101, dtype=float)
+    sketch = KLLSketch()
+    sketch.update_many(values)
+    assert sketch.n == 100
+    assert sketch.quantiles([0.1, 0.5, 0.9]).tolist() == [10.0, 50.0, 90.0]
+
+
+def test_kll_rank_error_is_small():
+    values = np.random.default_rng(1).lognormal(4, 0.5, 200_000)
+    sketch = KLLSketch()
+    sketch.update_many(values)
+    assert sketch.n == len(values)
+    for q, estimate in zip(query_engine.DOSAGE_PERCENTILES, sketch.quantiles(query_engine.DOSAGE_PERCENTILES)):
+        assert rank_error(values, estimate, q) < 0.02
+
+
+def test_kll_merge_matches_one_sketch():
+    rng = np.random.default_rng(2)
+    left, right = rng.normal(50, 10, 60_000), rng.normal(120, 20, 40_000)
+    a, b = KLLSketch(seed=1), KLLSketch(seed=2)
+    a.update_many(left)
+    b.update_many(right)
+    b_n = b.n
+
+    merged = KLLSketch().merge(a).merge(b)
+    assert merged.n == len(left) + len(right)
+    assert b.n == b_n  # merging leaves the source untouched
+    values = np.concatenate([left, right])
+    for q, estimate in zip([0.1, 0.5, 0.9], merged.quantiles([0.1, 0.5, 0.9])):
+        assert rank_error(values, estimate, q) < 0.02
+
+
+def test_sketch_index_follows_sidebar_filters(seed_df):
+    index = DosageSketchIndex.from_frame(seed_df)
+    for focus, chemicals, min_rating in [(None, None, 1), (["PTSD"], None, 1), (["PTSD", "Addiction"], ["Ketamine"], 3)]:
+        filtered = query_engine.apply_sidebar_filters(seed_df, focus, chemicals, min_rating)
+        from_index = query_engine.dosage_percentiles_for(filtered, index, focus, min_rating)
+        direct = query_engine.dosage_percentiles_for(filtered)
+        assert from_index["Records"].sum() == len(filtered)
+        assert from_index.drop(columns="Group").equals(direct.drop(columns="Group"))
+
+
+def test_sketch_index_add_counts_a_record_once(seed_df):
+    index = DosageSketchIndex.from_frame(seed_df)
+    index.add(seed_df.iloc[0].to_dict())
+    assert query_engine.dosage_percentiles_for(seed_df, index)["Records"].sum() == len(seed_df) + 1
+
+
+def percentile_chart_records(at) -> int:
+    """Total Records in the dosage percentile chart of a finished AppTest run."""
+    import pyarrow as pa
+
+    for chart in at.get("vega_lite_chart"):
+        if "Percentiles" not in chart.proto.spec:
+            continue
+        blobs = [ds.data.data for ds in chart.proto.datasets] + [chart.proto.data.data]
+        frames = [pa.ipc.open_stream(blob).read_pandas() for blob in blobs if blob]
+        return int(sum(frame["Records"].sum() for frame in frames if "Records" in frame))
+    raise AssertionError("No dosage percentile chart on the page")
+
+
+def test_app_counts_an_appended_record_once(tmp_path, monkeypatch, seed_df):
+    testing = pytest.importorskip("streamlit.testing.v1")
+    csv_path = tmp_path / "ppn.csv"
+    csv_path.write_bytes(open(SEED_CSV, "rb").read())
+    monkeypatch.setenv("PPN_CSV_PATH", str(csv_path))
+
+    app_path = os.path.join(os.path.dirname(SEED_CSV), "app.py")
+    at = testing.AppTest.from_file(app_path, default_timeout=60).run()
+    find = lambda elements, label: next(el for el in elements if el.label == label)
+    find(at.text_input, "Username").set_value("admin")
+    find(at.text_input, "Password").set_value("password")
+    find(at.button, "Log in").click().run()
+
+    # Add the record before the search page has built the sketch index
+    at.sidebar.radio[0].set_value("Add New Record").run()
+    find(at.text_input, "Practitioner Name").set_value("Dr. T. Test")
+    find(at.text_input, "Client ID").set_value("P-T001")
+    find(at.button, "Submit").click().run()
+    assert not at.exception
+
+    at.sidebar.radio[0].set_value("Search Database").run()
+    assert percentile_chart_records(at) == len(seed_df) + 1
+
+
+# ----------------------------
+# CSV loading + quarantine
+# ----------------------------
+def seed_rows() -> list:
+    with open(SEED_CSV, "r", encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))
+
+
+def csv_line(row: list) -> str:
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerow(row)
+    return out.getvalue()[:-1]
+
+
+def with_value(row: list, col: str, value: str) -> list:
+    out = list(row)
+    out[query_engine.REQUIRED_COLS.index(col)] = value
+    return out
+
+
+def write_dirty_csv(path, newline: str = "\n", bom: bool = False):
+    """Seed rows mixed with every kind of bad row; the comments give the physical line."""
+    header, *rows = seed_rows()
+    lines = [
+        csv_line(header),  # 1
+        csv_line(rows[0]),  # 2
+        csv_line(with_value(rows[1], "Protocol_Description", "Quoted\nover two lines")),  # 3-4
+        csv_line(rows[2][:12]),  # 5: short row
+        "",  # 6: blank line
+        csv_line(with_value(rows[3], "Dosage_Mg", "1e30")),  # 7
+        csv_line(rows[4] + ["extra"]),  # 8: long row
+        csv_line(with_value(rows[5], "Treatment_Date", "2024-13-40")),  # 9
+        csv_line(with_value(rows[6], "Patient_Age", " 41.0 ")),  # 10: accepted as 41
+        csv_line(with_value(rows[7], "Treatment_Outcome_Rating", "")),  # 11
+        csv_line(with_value(rows[8], "Patient_Age", "131")),  # 12: out of range
+        csv_line(rows[9]),  # 13
+    ]
+    data = newline.join(lines) + newline
+    path.write_bytes((b"\xef\xbb\xbf" if bom else b"") + data.encode("utf-8"))
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+@pytest.mark.parametrize("bom", [False, True])
+def test_load_data_quarantines_bad_rows_by_physical_line(tmp_path, newline, bom):
+    path = tmp_path / "dirty.csv"
+    write_dirty_csv(path, newline=newline, bom=bom)
+    with pytest.warns(UserWarning, match="quarantined 6 row"):
+        df, quarantine = query_engine.load_data(str(path))
+
+    assert quarantine["Line"].tolist() == [5, 7, 8, 9, 11, 12]
+    reasons = quarantine["Reason"].tolist()
+    assert reasons[0].startswith("Malformed row") and reasons[2].startswith("Malformed row")
+    assert reasons[1] == "Bad Dosage_Mg"
+    assert reasons[3] == "Bad Treatment_Date"
+    assert reasons[4] == "Bad Treatment_Outcome_Rating"
+    assert reasons[5] == "Bad Patient_Age"
+    assert quarantine.loc[1, "Dosage_Mg"] == "1e30"  # reported as read, not as a cast value
+
+    # Kept: lines 2, 3-4, 10 and 13
+    assert len(df) == 4
+    assert df["Practitioner_Name"].str.len().gt(0).all()
+    assert str(df.loc[1, "Protocol_Description"]) == "Quoted\nover two lines"
+    assert df.loc[2, "Patient_Age"] == 41
+
+
+def test_load_data_quarantines_every_row_without_a_required_column(tmp_path):
+    path = tmp_path / "no_name.csv"
+    path.write_text("\n".join(csv_line(row[1:]) for row in seed_rows()) + "\n", encoding="utf-8")
+    with pytest.warns(UserWarning, match="missing required column"):
+        df, quarantine = query_engine.load_data(str(path))
+    assert df.empty
+    assert (quarantine["Reason"] == "Missing column Practitioner_Name").all()
+
+
+def test_load_data_falls_back_when_the_file_is_missing(tmp_path):
+    df, quarantine = query_engine.load_data(str(tmp_path / "missing.csv"))
+    assert len(df) > 0 and quarantine.empty
+
+
+# ----------------------------
+# Search
+# ----------------------------
+def joined_row_search(df_in, query: str):
+    """The original search: a case-insensitive regex over each row joined with " | "."""
+    q = (query or "").strip().lower()
+    if not q:
+        return df_in
+    combined = df_in.astype(str).apply(lambda row: " | ".join(row.values), axis=1).str.lower()
+    return df_in.loc[combined.str.contains(q, na=False)]
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "",
+        "ptsd",
+        "Ketamine",
+        "P-1378",
+        "Dr. A. Smith",
+        "dr.",
+        "follow up",
+        "2025-05",
+        "drank",
+        "ketamine.*injected",
+        "^dr",
+        "4$",
+        "(ptsd|anxiety)",
+        "p-1[0-9]+",
+        "m | ptsd",
+        "psilocybin | ",
+    ],
+)
+def test_search_filter_matches_joined_row_search(seed_df, query):
+    expected = joined_row_search(seed_df, query)
+    got = query_engine.search_filter(seed_df, query)
+    assert got.index.tolist() == expected.index.tolist()